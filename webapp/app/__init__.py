@@ -16,6 +16,10 @@ app.config.update(dict(
     TTN_APP_ID='lankheet',
     TTN_PORT=8883,
     TTN_RECEIVE_ONLY=False,
+    # Seconds to wait before reconnecting to MQTT, doubling on every
+    # failed attempt up to the maximum
+    TTN_RECONNECT_MIN_DELAY=1,
+    TTN_RECONNECT_MAX_DELAY=120,
     DEVICES={
         # Maps TTN device id to list of connected battery ids
         'stuurkast-3': ['lankheet-1', 'lankheet-2'],
@@ -35,6 +39,16 @@ app.config.update(dict(
     CALIBRATION_OFFSET_MA=-4,
     DEFAULT_CALIBRATION_MA_PER_CM=0.15,
     DEFAULT_CALIBRATION_OFFSET_CM=0,
+
+    # Number of recent statuses per battery kept in memory and sent to
+    # clients that request history (144 is a day of 10-minute uplinks)
+    HISTORY_LENGTH=144,
+
+    # Number of months of statuses (besides the current month) kept in
+    # the database, older months are moved to ARCHIVE_PATH by
+    # `flask archive-status`.
+    STATUS_RETENTION_MONTHS=12,
+    ARCHIVE_PATH=os.path.join(app.root_path, 'archive'),
 ))
 
 # Load config.py
@@ -56,13 +70,15 @@ mail = flask_mail.Mail(app)
 
 # Import these at the end, so they can access a completely setup
 # core.app
-from . import mqtt, database, web, websocket, auth
+from . import mqtt, database, archive, web, websocket, auth, assets, profiling
 
 # This is a hack to prevent running these when doing "flask initdb". There
 # seems to be no sane way to run a command only when actually running a server
 # (using flask run or inside gunicorn or whatever), so this just checks for
 # initdb explicitely.
-if 'initdb' not in sys.argv and 'invite' not in sys.argv:
+if not any(cmd in sys.argv for cmd in ('initdb', 'invite', 'build-assets',
+                                       'partition-status', 'archive-status',
+                                       'profile-ingest')):
     core.setup()
 
     mqtt.run(app)
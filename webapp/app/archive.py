@@ -0,0 +1,191 @@
+import os
+import gzip
+import json
+from datetime import datetime
+
+from . import database, app
+
+# Archive files contain one month of status rows each, stored as a
+# gzipped JSON object with a list of values per column.
+ARCHIVE_FILE = 'status-{:%Y-%m}.json.gz'
+
+def month_start(timestamp):
+    return timestamp.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+def add_months(timestamp, months):
+    years, month = divmod(timestamp.month - 1 + months, 12)
+    return timestamp.replace(year=timestamp.year + years, month=month + 1)
+
+def months_between(start, end):
+    """ Yield the start of every month from start up to (excluding) end. """
+    month = month_start(start)
+    while month < end:
+        yield month
+        month = add_months(month, 1)
+
+def archive_cutoff():
+    """ Return the start of the oldest month that is kept in the database. """
+    return add_months(month_start(datetime.now()), -app.config['STATUS_RETENTION_MONTHS'])
+
+def archive_path(month):
+    return os.path.join(app.config['ARCHIVE_PATH'], ARCHIVE_FILE.format(month))
+
+def partition_name(month):
+    return 'p{:%Y%m}'.format(month)
+
+def format_timestamp(timestamp):
+    if isinstance(timestamp, datetime):
+        return timestamp.strftime(database.datetime_fmt)
+    return timestamp
+
+def read_archive(month):
+    """ Return the status rows archived for the given month, as dicts. """
+    try:
+        with gzip.open(archive_path(month), 'rt') as f:
+            columns = json.load(f)
+    except FileNotFoundError:
+        return []
+    names = list(columns.keys())
+    return [dict(zip(names, values)) for values in zip(*columns.values())]
+
+def write_archive(month, rows):
+    """ Write the given status rows (dicts) to the archive for the given month. """
+    columns = {}
+    for row in rows:
+        for key, value in row.items():
+            columns.setdefault(key, []).append(format_timestamp(value))
+
+    os.makedirs(app.config['ARCHIVE_PATH'], exist_ok=True)
+    path = archive_path(month)
+    # Write to a temporary file first, so a crash never leaves a
+    # partial archive behind
+    with gzip.open(path + '.tmp', 'wt') as f:
+        json.dump(columns, f, separators=(',', ':'))
+    os.replace(path + '.tmp', path)
+
+def select_status(db, where, params, extra=''):
+    query = 'select * from status where {} {}'.format(' and '.join(where), extra)
+    c = db.cursor()
+    c.execute(query, params)
+    return c.fetchall()
+
+def get_status_rows(db, battery, start, end):
+    """
+    Get the status rows for the given battery between start (inclusive)
+    and end (exclusive), ordered by timestamp. Rows are read from the
+    archive files for every month in that range that has one, and from
+    the database. Returns row dicts, with parsed timestamps.
+    """
+    where = ['battery={}'.format(database.placeholder),
+             'timestamp >= {}'.format(database.placeholder),
+             'timestamp < {}'.format(database.placeholder)]
+    rows = [database.row_to_dict(row) for row in select_status(db, where, [battery, start, end])]
+
+    # An interrupted archive-status run can leave rows both archived and
+    # in the database, so skip archived rows the database returned too
+    seen = {r['id'] for r in rows if r['id'] is not None}
+    seen.update(format_timestamp(r['timestamp']) for r in rows if r['id'] is None)
+    for month in months_between(start, end):
+        for row in read_archive(month):
+            key = row['id'] if row['id'] is not None else row['timestamp']
+            if row['battery'] == battery and key not in seen:
+                rows.append(row)
+
+    for row in rows:
+        row['timestamp'] = database.parse_timestamp(row['timestamp'])
+    rows = [r for r in rows if start <= r['timestamp'] < end]
+    rows.sort(key=lambda r: (r['timestamp'], r['id'] or 0))
+    return rows
+
+def get_partitions(db):
+    """ Return the names of the partitions of the status table (MySQL only). """
+    c = db.cursor()
+    c.execute("select partition_name from information_schema.partitions"
+              " where table_schema = database() and table_name = 'status'"
+              " and partition_name is not null")
+    return [row['partition_name'] for row in c.fetchall()]
+
+def partition_definition(month):
+    return "partition {} values less than (unix_timestamp('{:%Y-%m-%d %H:%M:%S}'))".format(
+        partition_name(month), add_months(month, 1))
+
+def add_partitions(db, until):
+    """
+    Make sure the partitioned status table has a partition for every
+    month up to (excluding) the given month, by splitting them off the
+    catch-all pmax partition.
+    """
+    existing = get_partitions(db)
+    last = max(p for p in existing if p != 'pmax')
+    month = add_months(datetime.strptime(last, 'p%Y%m'), 1)
+    new = [partition_definition(m) for m in months_between(month, until)]
+    if new:
+        c = db.cursor()
+        c.execute('alter table status reorganize partition pmax into ({}, '
+                  'partition pmax values less than maxvalue)'.format(', '.join(new)))
+
+@app.cli.command('partition-status')
+def partition_status_command():
+    """Partitions the status table by month (MySQL only)."""
+    if not database.use_mysql:
+        print('Partitioning is only supported on MySQL, on SQLite use archive-status')
+        return
+    db = app.get_db()
+    if get_partitions(db):
+        print('Status table is already partitioned')
+        return
+
+    c = db.cursor()
+    c.execute('select min(timestamp) as first from status')
+    first = c.fetchone()['first'] or datetime.now()
+    until = add_months(month_start(datetime.now()), 2)
+    partitions = [partition_definition(m) for m in months_between(first, until)]
+    partitions.append('partition pmax values less than maxvalue')
+
+    # MySQL requires the partitioning column to be part of the primary key
+    c.execute('alter table status drop primary key, add primary key (id, timestamp)')
+    c.execute('alter table status partition by range (unix_timestamp(`timestamp`)) ({})'.format(
+        ', '.join(partitions)))
+    db.commit()
+    print('Partitioned status table into {} partitions'.format(len(partitions)))
+
+@app.cli.command('archive-status')
+def archive_status_command():
+    """Moves status rows older than the retention period to archive files."""
+    db = app.get_db()
+    c = db.cursor()
+    c.execute('select min(timestamp) as first from status')
+    first = database.parse_timestamp(c.fetchone()['first'])
+    partitions = get_partitions(db) if database.use_mysql else []
+
+    cutoff = archive_cutoff()
+    if first is not None:
+        for month in months_between(first, cutoff):
+            where = ['timestamp >= {}'.format(database.placeholder),
+                     'timestamp < {}'.format(database.placeholder)]
+            params = [month, add_months(month, 1)]
+            rows = [database.row_to_dict(row) for row in select_status(db, where, params, 'order by timestamp, id')]
+            if not rows:
+                continue
+
+            # Merge with rows archived earlier, in case a previous run
+            # was interrupted after writing the archive
+            archived = read_archive(month)
+            seen = {(r['battery'], r['timestamp']) for r in archived}
+            new = [r for r in rows if (r['battery'], format_timestamp(r['timestamp'])) not in seen]
+            write_archive(month, archived + new)
+
+            # Dropping a partition is much cheaper than deleting rows
+            if partition_name(month) in partitions:
+                c.execute('alter table status drop partition {}'.format(partition_name(month)))
+            else:
+                c.execute('delete from status where ' + ' and '.join(where), params)
+            db.commit()
+            print('Archived {} rows for {:%Y-%m}'.format(len(rows), month))
+
+    if partitions:
+        # Keep a partition ready for next month
+        add_partitions(db, add_months(month_start(datetime.now()), 2))
+        db.commit()
+
+# vim: set sts=4 sw=4 expandtab:
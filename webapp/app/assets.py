@@ -0,0 +1,151 @@
+import os
+import json
+import gzip
+import hashlib
+import mimetypes
+import click
+import flask
+
+from . import app
+
+# Built assets are written into this subdirectory of the static folder,
+# with a content hash in their filename and precompressed variants next
+# to them.
+DIST_DIR = 'dist'
+MANIFEST_FILE = 'manifest.json'
+# Fingerprinted files never change, so clients can cache them forever
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# Encodings to precompress to, in order of preference when serving.
+# Brotli is optional, if the module is not installed only gzip is used.
+ENCODINGS = [('gzip', '.gz', lambda data: gzip.compress(data, 9))]
+try:
+    import brotli
+    ENCODINGS.insert(0, ('br', '.br', lambda data: brotli.compress(data, quality=11)))
+except ImportError:
+    pass
+
+# Maps original static filenames to fingerprinted filenames
+manifest = {}
+
+def dist_path(*parts):
+    return os.path.join(app.static_folder, DIST_DIR, *parts)
+
+def load_manifest():
+    manifest.clear()
+    try:
+        with open(dist_path(MANIFEST_FILE)) as f:
+            manifest.update(json.load(f))
+    except FileNotFoundError:
+        app.logger.info('No asset manifest found, serving unbuilt static files')
+
+def prune_assets(keep):
+    """
+    Remove built files (including compressed variants) that are not
+    listed in keep, a collection of filenames relative to the static
+    folder.
+    """
+    keep = set(keep)
+    keep.add(DIST_DIR + '/' + MANIFEST_FILE)
+    removed = 0
+    for root, dirs, files in os.walk(dist_path()):
+        for name in files:
+            path = os.path.join(root, name)
+            filename = os.path.relpath(path, app.static_folder).replace(os.sep, '/')
+            for encoding, suffix, compress in ENCODINGS:
+                if filename.endswith(suffix):
+                    filename = filename[:-len(suffix)]
+            if filename not in keep:
+                os.remove(path)
+                removed += 1
+    return removed
+
+@app.cli.command('build-assets')
+@click.option('--prune', is_flag=True,
+              help='Only remove assets not used by the current build, without building')
+def build_assets_command(prune):
+    """Fingerprints and precompresses static assets.
+
+    Files from previous builds are kept, since running servers, cached
+    pages and clients might still refer to them. Remove them with
+    --prune once all servers have been restarted.
+    """
+    if prune:
+        removed = prune_assets(manifest.values())
+        print('Removed {} unused files from {}'.format(removed, dist_path()))
+        return
+
+    new_manifest = {}
+    for root, dirs, files in os.walk(app.static_folder):
+        # Skip the output directory itself
+        if os.path.abspath(root) == os.path.abspath(app.static_folder):
+            dirs[:] = [d for d in dirs if d != DIST_DIR]
+        for name in files:
+            path = os.path.join(root, name)
+            filename = os.path.relpath(path, app.static_folder).replace(os.sep, '/')
+            with open(path, 'rb') as f:
+                data = f.read()
+
+            stem, ext = os.path.splitext(filename)
+            digest = hashlib.md5(data).hexdigest()[:12]
+            fingerprinted = '{}.{}{}'.format(stem, digest, ext)
+            new_manifest[filename] = DIST_DIR + '/' + fingerprinted
+
+            target = dist_path(fingerprinted)
+            # The name includes the content hash, so an existing file
+            # is already up to date
+            if os.path.exists(target):
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            write_file(target, data)
+            for encoding, suffix, compress in ENCODINGS:
+                compressed = compress(data)
+                # Do not bother when compressing does not help (e.g. images)
+                if len(compressed) < len(data):
+                    write_file(target + suffix, compressed)
+
+    write_file(dist_path(MANIFEST_FILE),
+               json.dumps(new_manifest, indent=4, sort_keys=True).encode('utf8'))
+    load_manifest()
+    print('Built {} assets into {}'.format(len(new_manifest), dist_path()))
+
+def write_file(path, data):
+    """ Write a file atomically, so it is never served half-written. """
+    with open(path + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(path + '.tmp', path)
+
+@app.url_defaults
+def fingerprint_static_url(endpoint, values):
+    """ Make url_for('static', ...) point to the fingerprinted file. """
+    if endpoint == 'static' and values.get('filename') in manifest:
+        values['filename'] = manifest[values['filename']]
+
+def send_static_file(filename):
+    """
+    Replacement for the default static view, that serves a precompressed
+    variant if the client accepts it and marks fingerprinted files as
+    immutable. Responses get an ETag and honor conditional requests.
+    """
+    accepted = flask.request.accept_encodings
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    for encoding, suffix, compress in ENCODINGS:
+        if (accepted[encoding]
+                and os.path.isfile(os.path.join(app.static_folder, filename + suffix))):
+            response = flask.send_from_directory(app.static_folder, filename + suffix,
+                                                 mimetype=mimetype, conditional=True)
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = flask.send_from_directory(app.static_folder, filename,
+                                             mimetype=mimetype, conditional=True)
+
+    response.vary.add('Accept-Encoding')
+    if filename.startswith(DIST_DIR + '/'):
+        response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    return response
+
+app.view_functions['static'] = send_static_file
+load_manifest()
+
+# vim: set sts=4 sw=4 expandtab:
@@ -1,4 +1,5 @@
 from datetime import datetime
+import collections
 import flask_user
 import pprint
 
@@ -6,6 +7,14 @@ from . import mqtt, websocket, database, app
 
 batteries = {}
 
+# Status fields kept in the recent history, with the number of values
+# for each
+HISTORY_CHANNELS = (
+    ('currentLevel', 3),
+    ('forwardFlow', 2),
+    ('reverseFlow', 2),
+    ('pump', 4),
+)
 
 def setup():
     with app.app_context():
@@ -15,14 +24,24 @@ def setup():
                 batteries[battery] = {
                     'status': None,
                     'config': None,
+                    'history': collections.deque(maxlen=app.config['HISTORY_LENGTH']),
+                    'history_bundle': None,
+                    # Raw payload of the last uplink, only set when it
+                    # needs no further processing if received again
+                    'payload': None,
                 }
                 configrow = database.get_most_recent(db, 'config', {'battery': battery})
                 if configrow:
                     batteries[battery]['config'] = database.config_row_to_message(configrow)
-                statusrow = database.get_most_recent(db, 'status', {'battery': battery})
-                if statusrow:
-                    batteries[battery]['status'] = database.status_row_to_message(statusrow)
-    app.logger.info("Startup state:\n%s", pp_obj(batteries))
+                statusrows = database.get_recent(db, 'status', {'battery': battery}, app.config['HISTORY_LENGTH'])
+                for statusrow in reversed(statusrows):
+                    status = database.status_row_to_message(statusrow)
+                    batteries[battery]['history'].append(history_entry(status))
+                    batteries[battery]['status'] = status
+    app.logger.info("Startup state:\n%s", pp_obj({
+        battery: {'status': info['status'], 'config': info['config']}
+        for battery, info in batteries.items()
+    }))
 
 def update_timeout(config):
     now = datetime.now()
@@ -61,8 +80,92 @@ def status_for_battery(battery):
 def config_for_battery(battery):
     return batteries[battery]['config']
 
-def process_uplink(status):
+def history_entry(status):
+    """
+    Convert a status into a compact tuple for the recent history: the
+    unix timestamp, followed by the values of all HISTORY_CHANNELS.
+    """
+    entry = [int(status['timestamp'].timestamp())]
+    for key, count in HISTORY_CHANNELS:
+        entry.extend(int(v) for v in status[key])
+    return tuple(entry)
+
+def delta_encode(values):
+    """ Replace each value by its difference with the previous one. """
+    result = []
+    prev = 0
+    for value in values:
+        result.append(value - prev)
+        prev = value
+    return result
+
+def history_for_battery(battery):
+    """
+    Return the recent history of the given battery in columnar form: a
+    list of timestamps and a list per channel for each of
+    HISTORY_CHANNELS (e.g. three lists for currentLevel). All lists are
+    delta-encoded: the first value is absolute, each next value is the
+    difference with the previous value.
+
+    The result is cached until the next uplink for this battery, so it
+    is built only once for all clients that connect in between.
+    """
+    info = batteries[battery]
+    if info['history_bundle'] is None:
+        entries = list(info['history'])
+        columns = list(zip(*entries))
+        if not columns:
+            columns = [()] * (1 + sum(count for key, count in HISTORY_CHANNELS))
+
+        bundle = {
+            'battery': battery,
+            'timestamps': delta_encode(columns[0]),
+        }
+        i = 1
+        for key, count in HISTORY_CHANNELS:
+            bundle[key] = [delta_encode(column) for column in columns[i:i + count]]
+            i += count
+        info['history_bundle'] = bundle
+    return info['history_bundle']
+
+def process_unchanged_uplink(battery, payload_raw):
+    """
+    Handle an uplink that is byte-identical to the previous one, when
+    that one matched the config. Instead of processing it again, only
+    the repeat is recorded on the previous status row and a heartbeat
+    is sent. Returns False if the payload is not identical, in which
+    case the uplink should be processed normally.
+    """
+    info = batteries[battery]
+    if info['payload'] is None or info['payload'] != payload_raw:
+        return False
+
+    now = datetime.now()
+    status = info['status']
+    if status['id'] is None:
+        return False
+
+    with app.app_context():
+        db = app.get_db()
+        cur = database.update_from_dict(db, 'status', {'id': status['id']}, {
+            'lastTimestamp': now,
+            'repeatCount': status['repeatCount'] + 1,
+        })
+    # The previous row is gone (e.g. archived), so store this one in full
+    if cur.rowcount == 0:
+        return False
+
+    status['lastTimestamp'] = now
+    status['repeatCount'] += 1
+    info['history'].append(history_entry(dict(status, timestamp=now)))
+    info['history_bundle'] = None
+    websocket.send_heartbeat(battery, now)
+    return True
+
+def process_uplink(status, payload_raw=None):
     status['timestamp'] = datetime.now()
+    status['lastTimestamp'] = status['timestamp']
+    status['repeatCount'] = 0
 
     app.logger.debug("Received status: %s", status)
     values = database.status_message_to_row(status)
@@ -74,15 +177,22 @@ def process_uplink(status):
 
     with app.app_context():
         db = app.get_db()
-        database.insert_from_dict(db, 'status', values)
+        cur = database.insert_from_dict(db, 'status', values)
+        status['id'] = cur.lastrowid
         batteries[battery]['status'] = status
+        batteries[battery]['history'].append(history_entry(status))
+        batteries[battery]['history_bundle'] = None
 
         # See if the status matches the current config, and if not resend
         # the config
         config = batteries[battery]['config']
+        # Identical uplinks can skip processing, unless a config must
+        # be resent
+        batteries[battery]['payload'] = payload_raw
 
         if config:
             if not status_matches_config(status, config):
+                batteries[battery]['payload'] = None
                 # Config does not match, resend
                 # First update timeout to subtract elapsed time
                 config = dict(config)
@@ -117,8 +227,10 @@ def process_command(config):
     db.commit()
     config['id'] = cur.lastrowid
 
-    # Update last-known config
+    # Update last-known config, identical uplinks must now be checked
+    # against it again
     batteries[config['battery']]['config'] = config
+    batteries[config['battery']]['payload'] = None
     # Send config to node
     mqtt.send_command(app, config)
 
@@ -32,14 +32,26 @@ def get_mysql_db():
             cursorclass=pymysql.cursors.DictCursor)
     return g.mysql_db
 
-if 'MYSQL_DB' in app.config:
+def use_sqlite_db(path):
+    """ Switch to using the sqlite database at the given path. """
+    global use_mysql, placeholder, datetime_fmt, seconds_between
+    app.config['DATABASE'] = path
+    app.get_db = get_sqlite_db
+    use_mysql = False
+    placeholder = '?'
+    datetime_fmt = '%Y-%m-%d %H:%M:%S.%f'
+    # SQL expression for the number of whole seconds between two
+    # columns (rounded, since julianday is not exact)
+    seconds_between = 'cast(round((julianday({1}) - julianday({0})) * 86400) as integer)'
+
+use_mysql = 'MYSQL_DB' in app.config
+if use_mysql:
         app.get_db = get_mysql_db
         placeholder = '%s'
         datetime_fmt = '%Y-%m-%d %H:%M:%S'
+        seconds_between = 'timestampdiff(second, {0}, {1})'
 else:
-        app.get_db = get_sqlite_db
-        placeholder = '?'
-        datetime_fmt = '%Y-%m-%d %H:%M:%S.%f'
+        use_sqlite_db(app.config['DATABASE'])
 
 @app.teardown_appcontext
 def close_db(error):
@@ -47,10 +59,8 @@ def close_db(error):
     if hasattr(g, 'sqlite_db'):
         g.sqlite_db.close()
 
-@app.cli.command('initdb')
-def initdb_command():
-    """Initializes the database."""
-    db = app.get_db()
+def create_schema(db):
+    """Creates the tables for statuses and configs."""
     c = db.cursor()
     with app.open_resource('schema.sql', mode='r') as f:
         # sqlite3 needs executescript to run multiple statements, Mysql
@@ -60,6 +70,11 @@ def initdb_command():
         else:
             c.execute(f.read())
     db.commit()
+
+@app.cli.command('initdb')
+def initdb_command():
+    """Initializes the database."""
+    create_schema(app.get_db())
     sqla.create_all();
     print('Initialized the database.')
 
@@ -67,7 +82,11 @@ def initdb_command():
 def parse_timestamp(timestamp):
     if timestamp is None or isinstance(timestamp, datetime):
         return timestamp
-    return datetime.strptime(timestamp, datetime_fmt)
+    try:
+        return datetime.strptime(timestamp, datetime_fmt)
+    except ValueError:
+        # sqlite3 leaves out the microseconds when they are zero
+        return datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S')
 
 
 def config_message_to_row(msg):
@@ -113,6 +132,8 @@ def status_message_to_row(msg):
     # TODO: Store currentLevelRaw values?
     return {
       'timestamp': msg['timestamp'],
+      'lastTimestamp': msg['lastTimestamp'],
+      'repeatCount': msg['repeatCount'],
       'manualTimeout': msg['manualTimeout'],
       'battery': msg['battery'],
       'panic': msg['panic'],
@@ -140,9 +161,17 @@ def status_message_to_row(msg):
     }
 
 def status_row_to_message(row):
+    timestamp = parse_timestamp(row['timestamp'])
+    last_timestamp = row_get(row, 'lastTimestamp')
+    # Rows from before lastTimestamp was added might not have it (in
+    # older archives), or have it NULL or zero (a zero date on MySQL)
+    if not last_timestamp or last_timestamp == '0000-00-00 00:00:00':
+        last_timestamp = timestamp
     return {
       'id': row['id'],
-      'timestamp': parse_timestamp(row['timestamp']),
+      'timestamp': timestamp,
+      'lastTimestamp': parse_timestamp(last_timestamp),
+      'repeatCount': row_get(row, 'repeatCount', 0),
       'manualTimeout': row['manualTimeout'],
       'battery': row['battery'],
       'pump': [row['pump0'], row['pump1'], row['pump2'], row['pump3']],
@@ -150,11 +179,20 @@ def status_row_to_message(row):
       'targetLevel': [row['targetLevel1'], row['targetLevel2'], row['targetLevel3']],
       'minLevel': [row['minLevel1'], row['minLevel2'], row['minLevel3']],
       'maxLevel': [row['maxLevel1'], row['maxLevel2'], row['maxLevel3']],
-      'currentFlow': [row['flowIn'], row['flowOut']],
+      'forwardFlow': [row['fwdFlowIn'], row['fwdFlowOut']],
+      'reverseFlow': [row['revFlowIn'], row['revFlowOut']],
       'currentLevel': [row['currentLevel1'], row['currentLevel2'], row['currentLevel3']],
       'panic': row['panic'],
     }
 
+def row_to_dict(row):
+    """ Convert a sqlite3.Row or pymysql dict row into a plain dict. """
+    return {key: row[key] for key in row.keys()}
+
+def row_get(row, key, default=None):
+    """ Like dict.get(), but also works for sqlite3.Row. """
+    return row[key] if key in row.keys() else default
+
 def insert_from_dict(db, table, values):
     """
     Create and execute an insert query using the keys from the passed dict as
@@ -168,6 +206,10 @@ def insert_from_dict(db, table, values):
     )
     c = db.cursor()
     c.execute(query, list(values.values()))
+    if not use_mysql and 'id' not in values:
+        # The schema is shared with MySQL, so on SQLite the id column is
+        # not an alias for the rowid and would stay NULL. Fill it in.
+        c.execute('update {} set id = rowid where rowid = ?'.format(table), [c.lastrowid])
     db.commit()
     return c
 
@@ -199,4 +241,49 @@ def get_most_recent(db, table, values):
     c.execute(query, list(values.values()))
     return c.fetchone()
 
+def get_recent(db, table, values, limit):
+    """
+    Get the limit most recent entries from the passed table, based on
+    the timestamp field, most recent first.
+    """
+    where = ''
+    if values:
+        where = 'where ' + ' and '.join('{}={}'.format(f, placeholder) for f in values.keys())
+    query = 'select * from {} {} order by timestamp desc limit {}'.format(table, where, int(limit))
+    c = db.cursor()
+    c.execute(query, list(values.values()))
+    return c.fetchall()
+
+def get_commands(db, battery=None, username=None, acked=None, before=None, limit=50):
+    """
+    Get a page of config rows (commands), newest first. Uses keyset
+    pagination: before should be a (timestamp, id) tuple from the last
+    row of the previous page, so every page is an index range scan
+    instead of skipping over all previous rows like OFFSET would.
+    Every row gets an extra ackLatency field, with the seconds between
+    sending and acking the command (None when not acked yet).
+    """
+    where = []
+    params = []
+    if battery is not None:
+        where.append('battery={}'.format(placeholder))
+        params.append(battery)
+    if username is not None:
+        where.append('username={}'.format(placeholder))
+        params.append(username)
+    if acked is not None:
+        where.append('ackTimestamp is {}null'.format('not ' if acked else ''))
+    if before is not None:
+        where.append('(timestamp < {0} or (timestamp = {0} and id < {0}))'.format(placeholder))
+        params.extend([before[0], before[0], before[1]])
+
+    query = 'select *, {} as ackLatency from config {} order by timestamp desc, id desc limit {}'.format(
+        seconds_between.format('timestamp', 'ackTimestamp'),
+        'where ' + ' and '.join(where) if where else '',
+        int(limit),
+    )
+    c = db.cursor()
+    c.execute(query, params)
+    return c.fetchall()
+
 # vim: set sw=4 sts=4 expandtab:
@@ -1,5 +1,6 @@
 import paho.mqtt.client as mqtt
 import threading
+import queue
 import json
 import base64
 import binascii
@@ -7,16 +8,23 @@ import configparser
 
 from . import core
 
+# Messages received on all connections, processed by a single ingestion
+# thread, so processing never runs concurrently. Contains (connection,
+# mqtt message) tuples.
+ingest_queue = queue.Queue()
+
 def on_connect(client, userdata, flags, rc):
     app = userdata['app']
-    app.logger.info('MQTT connected')
-    client.subscribe('+/devices/+/up')
+    connection = userdata['connection']
+    app.logger.info('MQTT connected: %s', connection['name'])
+    client.subscribe(connection['topic'])
     #client.subscribe('+/devices/+/events/activations')
     #client.subscribe('+/devices/+/events/down/sent')
 
 def on_disconnect(client, userdata, rc):
     app = userdata['app']
-    app.logger.warn('MQTT disconnected')
+    connection = userdata['connection']
+    app.logger.warn('MQTT disconnected: %s', connection['name'])
 
 def on_log(client, userdata, level, buf):
     app = userdata['app']
@@ -33,7 +41,24 @@ def on_log(client, userdata, level, buf):
         app.logger.debug(buf)
 
 def on_message(client, userdata, mqtt_msg):
-    app = userdata['app']
+    ingest_queue.put((userdata['connection'], mqtt_msg))
+
+def ingest_thread(app):
+    while True:
+        ingest_next(app)
+
+def ingest_next(app, block=True):
+    """ Process the next message from the ingestion queue. Returns
+        whether it was processed as an uplink. """
+    connection, mqtt_msg = ingest_queue.get(block)
+    try:
+        return handle_message(app, connection, mqtt_msg)
+    except Exception:
+        # Keep going for subsequent messages
+        app.logger.exception('Error processing MQTT packet from %s', connection['name'])
+        return False
+
+def handle_message(app, connection, mqtt_msg):
     try:
         msg_as_string = mqtt_msg.payload.decode('utf8')
         msg = json.loads(msg_as_string)
@@ -42,31 +67,37 @@ def on_message(client, userdata, mqtt_msg):
     # python2 uses ValueError and perhaps others, python3 uses JSONDecodeError
     except Exception as e:
         app.logger.warn('Error parsing MQTT packet\n' + str(e))
-        return
+        return False
 
-    try:
-        if 'port' in msg:
-            process_data(app, msg, payload_raw)
-    except Exception as e:
-        app.logger.warn('Error processing MQTT packet\n' + str(e))
-        raise
-        return
+    # Remember which connection a device talks through, so downlinks
+    # can be sent through the same connection
+    if 'dev_id' in msg:
+        app.mqtt_device_connections[msg['dev_id']] = connection['name']
+
+    if 'port' in msg:
+        return process_data(app, msg, payload_raw)
+    return False
 
 def process_data(app, msg, payload_raw):
     if msg["port"] != 1 and msg["port"] != 2:
         app.logger.info("Ignoring message with unknown port %s", msg["port"])
-        return
+        return False
     app.logger.debug("Raw msg: %s", binascii.hexlify(payload_raw))
     battery_num = msg["port"] - 1
     battery = device_to_battery(app, msg["dev_id"], battery_num)
+    if core.process_unchanged_uplink(battery, payload_raw):
+        app.logger.debug("Status unchanged for %s", battery)
+        return True
     status = decode_status(payload_raw)
     calibrate_status(app, battery, status)
     status['battery'] = battery
     app.logger.debug("Decoded status:\n%s", core.pp_obj(status))
-    core.process_uplink(status)
+    core.process_uplink(status, payload_raw)
+    return True
 
 def mqtt_thread(client):
-    client.loop_forever()
+    # Keeps reconnecting (with backoff) when the connection fails
+    client.loop_forever(retry_first_connection=True)
 
 def battery_to_device(app, battery):
 	""" Look up a battery id and return a tuple with device id and battery
@@ -81,6 +112,21 @@ def device_to_battery(app, device, battery_num):
 	""" Look up a battery id for the given device id and index."""
 	return app.config['DEVICES'][device][battery_num]
 
+def device_to_connection(app, device):
+    """ Look up the MQTT connection to use for sending to a device: the
+        connection it was last heard on, or the connection that lists it
+        in its devices, or the only connection if there is just one."""
+    connections = app.mqtt_connections
+    name = app.mqtt_device_connections.get(device)
+    if name in connections:
+        return connections[name]
+    for connection in connections.values():
+        if device in connection['devices']:
+            return connection
+    if len(connections) == 1:
+        return next(iter(connections.values()))
+    return None
+
 def send_command(app, config):
     device, battery_num = battery_to_device(app, config['battery'])
 
@@ -93,13 +139,18 @@ def send_command(app, config):
 	"payload_raw": base64.b64encode(encode_command(config)).decode('ascii'),
 	"schedule": "replace",
     }
-    topic = "{}/devices/{}/down".format(app.config['TTN_APP_ID'], device)
+    connection = device_to_connection(app, device)
+    if connection is None:
+        app.logger.error("No MQTT connection for device %s, not sending command", device)
+        return
+
+    topic = "{}/devices/{}/down".format(connection['app_id'], device)
     payload = json.dumps(msg)
-    if not app.config.get('TTN_RECEIVE_ONLY', False):
-        app.mqtt.publish(topic, payload)
-        app.logger.debug("Publishing to topic %s: %s", topic, payload)
+    if not app.config.get('TTN_RECEIVE_ONLY', False) and connection['client']:
+        connection['client'].publish(topic, payload)
+        app.logger.debug("Publishing to topic %s via %s: %s", topic, connection['name'], payload)
     else:
-        app.logger.debug("Would have published to topic %s: %s", topic, payload)
+        app.logger.debug("Would have published to topic %s via %s: %s", topic, connection['name'], payload)
 
 def encode_command(msg):
     raw = bytearray(16)
@@ -205,31 +256,80 @@ def write_calibration(app):
     with open(CALIBRATION_FILE, 'w') as f:
         app.calibration.write(f)
 
-def run(app):
-    # TODO: Calibration should probably be handled in its own module or core.
-    read_calibration(app)
-
-    if app.config.get('TTN_SKIP', False):
-        app.logger.info('Skipping MQTT connection')
-        return
-
-    client = mqtt.Client(userdata={'app': app})
+def connection_configs(app):
+    """
+    Return the configured MQTT connections, with defaults filled in from
+    the single-connection TTN_* settings. Without TTN_CONNECTIONS, this
+    is a single connection using just those settings.
+    """
+    defaults = {
+        'app_id': app.config['TTN_APP_ID'],
+        'access_key': app.config.get('TTN_ACCESS_KEY'),
+        'host': app.config['TTN_HOST'],
+        'port': app.config['TTN_PORT'],
+        'ca_cert_path': app.config['TTN_CA_CERT_PATH'],
+        'topic': '+/devices/+/up',
+        'devices': [],
+        'reconnect_min_delay': app.config['TTN_RECONNECT_MIN_DELAY'],
+        'reconnect_max_delay': app.config['TTN_RECONNECT_MAX_DELAY'],
+    }
+    configs = app.config.get('TTN_CONNECTIONS') or [{}]
+
+    connections = []
+    names = set()
+    for config in configs:
+        connection = dict(defaults)
+        connection.update(config)
+        # The same app can be used in multiple regions, so include the
+        # host in the default name
+        connection.setdefault('name', '{}@{}'.format(connection['app_id'], connection['host']))
+        if connection['name'] in names:
+            raise ValueError("Duplicate MQTT connection name `{}` in TTN_CONNECTIONS, set a unique name for each connection".format(connection['name']))
+        names.add(connection['name'])
+        connections.append(connection)
+    return connections
+
+def connect(app, connection):
+    client = mqtt.Client(userdata={'app': app, 'connection': connection})
     client.on_connect = on_connect
     client.on_message = on_message
     client.on_disconnect = on_disconnect
     client.on_log = on_log
 
-    client.username_pw_set(app.config['TTN_APP_ID'], app.config['TTN_ACCESS_KEY'])
-    client.tls_set(app.config['TTN_CA_CERT_PATH'])
-
-    host = app.config['TTN_HOST']
-    port = app.config['TTN_PORT']
-    app.logger.info('Connecting to %s on port %s', host, port)
+    client.username_pw_set(connection['app_id'], connection['access_key'])
+    client.tls_set(connection['ca_cert_path'])
+    client.reconnect_delay_set(connection['reconnect_min_delay'], connection['reconnect_max_delay'])
 
-    client.connect(host, port=port)
-    app.mqtt = client
+    host = connection['host']
+    port = connection['port']
+    app.logger.info('Connecting %s to %s on port %s', connection['name'], host, port)
 
+    # Connect from the thread, so a failing connection is retried
+    # there instead of failing startup
+    client.connect_async(host, port=port)
+    connection['client'] = client
 
     threading.Thread(target=mqtt_thread, args=(client,), daemon=True).start()
 
+def run(app):
+    # TODO: Calibration should probably be handled in its own module or core.
+    read_calibration(app)
+
+    # Maps connection name to connection, and device id to connection
+    # name of the last uplink from that device
+    app.mqtt_connections = {}
+    app.mqtt_device_connections = {}
+    for connection in connection_configs(app):
+        connection['client'] = None
+        app.mqtt_connections[connection['name']] = connection
+
+    if app.config.get('TTN_SKIP', False):
+        app.logger.info('Skipping MQTT connection')
+        return
+
+    threading.Thread(target=ingest_thread, args=(app,), daemon=True).start()
+
+    for connection in app.mqtt_connections.values():
+        connect(app, connection)
+
 # vim: set sts=4 sw=4 expandtab:
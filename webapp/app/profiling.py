@@ -0,0 +1,211 @@
+import os
+import sys
+import time
+import json
+import click
+import pstats
+import shutil
+import cProfile
+import tempfile
+import threading
+import collections
+from datetime import datetime
+import paho.mqtt.client as paho
+
+from . import core, mqtt, database, app
+
+# Config seeded for batteries that have none in the real database, so
+# reconciliation still runs
+DEFAULT_CONFIG = {
+    'manualTimeout': 0,
+    'pump': [0, 0, 0, 0],
+    'targetFlow': 0,
+    'targetLevel': [0, 0, 0],
+    'minLevel': [0, 0, 0],
+    'maxLevel': [0, 0, 0],
+}
+
+class StubClient:
+    """ Stands in for a paho client, recording instead of publishing. """
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, payload):
+        self.published.append((topic, payload))
+
+class StackSampler(threading.Thread):
+    """
+    Samples the stack of the given thread at a fixed interval, counting
+    how often each stack was seen.
+    """
+    def __init__(self, thread_id, interval):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            if stack:
+                self.stacks[tuple(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+def read_messages(path):
+    """
+    Read captured TTN messages, one JSON object per line, as received on
+    the uplink topic. Returns them as paho messages.
+    """
+    messages = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            msg = json.loads(line)
+            topic = '{}/devices/{}/up'.format(msg.get('app_id', ''), msg.get('dev_id', ''))
+            mqtt_msg = paho.MQTTMessage(topic=topic.encode('utf8'))
+            mqtt_msg.payload = line.encode('utf8')
+            messages.append(mqtt_msg)
+    return messages
+
+def setup_stub_connections():
+    """ Set up all configured connections with a stubbed broker. """
+    app.mqtt_connections = {}
+    app.mqtt_device_connections = {}
+    for connection in mqtt.connection_configs(app):
+        connection['client'] = StubClient()
+        app.mqtt_connections[connection['name']] = connection
+
+def read_configs():
+    """ Return the latest config of every battery in the real database. """
+    configs = {}
+    try:
+        with app.app_context():
+            db = app.get_db()
+            for batteries in app.config['DEVICES'].values():
+                for battery in batteries:
+                    row = database.get_most_recent(db, 'config', {'battery': battery})
+                    if row:
+                        configs[battery] = database.config_row_to_message(row)
+    except Exception as e:
+        app.logger.warning('Could not read configs from the database: %s', e)
+    return configs
+
+def seed_configs(db, configs):
+    """
+    Insert a config for every battery, using the passed configs where
+    available and DEFAULT_CONFIG otherwise.
+    """
+    for batteries in app.config['DEVICES'].values():
+        for battery in batteries:
+            config = dict(configs.get(battery, DEFAULT_CONFIG))
+            config.update({
+                'battery': battery,
+                'timestamp': datetime.now(),
+                'ackTimestamp': None,
+                'username': 'profile-ingest',
+            })
+            database.insert_from_dict(db, 'config', database.config_message_to_row(config))
+
+def count_statuses():
+    """ Return the number of status rows and the total of their repeats. """
+    with app.app_context():
+        c = app.get_db().cursor()
+        c.execute('select count(*) as count, coalesce(sum(repeatCount), 0) as repeats from status')
+        row = c.fetchone()
+        return row['count'], row['repeats']
+
+@app.cli.command('profile-ingest')
+@click.option('--input', 'input_path', required=True, type=click.Path(exists=True),
+              help='File with captured TTN messages, one JSON object per line')
+@click.option('--output', default='profile-ingest', help='Prefix for the output files')
+@click.option('--sort', default='cumulative', type=click.Choice(['cumulative', 'tottime', 'ncalls']),
+              help='Sort order of the hot-spot report')
+@click.option('--limit', default=40, help='Number of functions in the hot-spot report')
+@click.option('--interval', default=0.001, help='Sampling interval for the stack dump, in seconds')
+@click.option('--config-from-db/--no-config-from-db', default=True,
+              help='Seed the latest config of each battery from the real database')
+def profile_ingest_command(input_path, output, sort, limit, interval, config_from_db):
+    """Replays captured uplinks under the profiler.
+
+    Messages are fed through mqtt.on_message and the ingestion queue
+    into a scratch database, with a stubbed broker. This writes a
+    hot-spot report (<output>.txt), the raw profile (<output>.prof) and
+    sampled stacks in the collapsed format used by flamegraph.pl and
+    speedscope (<output>.folded).
+
+    Every battery gets a config in the scratch database, so uplinks are
+    also reconciled with it.
+    """
+    configs = read_configs() if config_from_db else {}
+    scratch = tempfile.mkdtemp()
+    try:
+        database.use_sqlite_db(os.path.join(scratch, 'profile.db'))
+        with app.app_context():
+            db = app.get_db()
+            database.create_schema(db)
+            seed_configs(db, configs)
+        mqtt.read_calibration(app)
+        setup_stub_connections()
+        core.setup()
+
+        messages = read_messages(input_path)
+        # All messages enter through the first connection
+        connection = next(iter(app.mqtt_connections.values()))
+        userdata = {'app': app, 'connection': connection}
+
+        profiler = cProfile.Profile()
+        sampler = StackSampler(threading.get_ident(), interval)
+        sampler.start()
+        start = time.perf_counter()
+        ingested = 0
+        profiler.enable()
+        for mqtt_msg in messages:
+            mqtt.on_message(connection['client'], userdata, mqtt_msg)
+            if mqtt.ingest_next(app, block=False):
+                ingested += 1
+        profiler.disable()
+        elapsed = time.perf_counter() - start
+        sampler.stop()
+
+        rows, repeats = count_statuses()
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    failed = len(messages) - ingested
+    if not ingested:
+        raise click.ClickException('None of the {} messages could be ingested, see the log for errors'.format(len(messages)))
+    # Every ingested uplink should be stored, either as a new row or as a
+    # repeat of the previous one. Otherwise the profile shows a broken
+    # path rather than what happens in production.
+    if rows + repeats != ingested:
+        raise click.ClickException('Ingested {} uplinks, but the database has {} statuses and {} repeats'.format(
+            ingested, rows, repeats))
+
+    summary = ('Ingested {} messages ({} failed or ignored, {} stored as new status, {} as repeat) '
+               'in {:.3f}s ({:.2f}ms per message)').format(
+        ingested, failed, rows, repeats, elapsed, 1000 * elapsed / len(messages))
+
+    with open(output + '.txt', 'w') as f:
+        f.write(summary + '\n\n')
+        stats = pstats.Stats(profiler, stream=f)
+        stats.strip_dirs().sort_stats(sort).print_stats(limit)
+    profiler.dump_stats(output + '.prof')
+    with open(output + '.folded', 'w') as f:
+        for stack, count in sampler.stacks.most_common():
+            f.write('{} {}\n'.format(';'.join(stack), count))
+
+    print(summary)
+    print('Wrote {0}.txt, {0}.prof and {0}.folded'.format(output))
+
+# vim: set sts=4 sw=4 expandtab:
@@ -25,11 +25,17 @@ create table config (
   `maxLevel4` int,
   primary key(id)
 );
+-- For keyset pagination of the command log
+create index config_timestamp on config(`timestamp`, `id`);
+create index config_battery_timestamp on config(`battery`, `timestamp`, `id`);
 
 drop table if exists status;
 create table status (
   `id` integer auto_increment,
   `timestamp` timestamp default 0,
+  -- Time of the last identical uplink, and the number of those
+  `lastTimestamp` timestamp null default null,
+  `repeatCount` int default 0,
   `battery` varchar(16),
   `panic` boolean,
   `manualTimeout` int,
@@ -56,3 +62,5 @@ create table status (
   `maxLevel3` int,
   primary key(id)
 );
+-- For history queries, which always select a time range of one battery
+create index status_battery_timestamp on status(`battery`, `timestamp`);
@@ -1,19 +1,138 @@
 import jinja2
 import flask
 import flask_user
-from . import core, app
+from datetime import datetime, timedelta
+from . import core, database, websocket, archive, app
+
+# Rendered index pages, keyed by user and battery id. The page only
+# depends on these (and on flashed messages, which are never cached),
+# so there is no need to rerun the template on every request. The
+# host-dependent base_url is not used by the template, so it is left
+# out of the key to prevent clients from growing the cache with
+# arbitrary Host headers.
+index_cache = {}
 
 @app.route('/')
 def index():
+    authenticated = flask_user.access.is_authenticated()
     context = {
-        'commands_allowed': flask_user.access.is_authenticated(),
+        'commands_allowed': authenticated,
         'id': flask.request.args.get('id'),
         'base_url': flask.request.base_url
     }
-    try:
-        return flask.render_template('index.html', **context)
-    except jinja2.TemplateSyntaxError as e:
-        app.logger.error("Template syntax error on {}:{}".format(e.filename, e.lineno))
-        raise
+
+    # Only cache known batteries, to prevent unbounded growth of the
+    # cache, and skip the cache in debug mode so template changes show
+    # up directly.
+    key = (
+        flask_user.current_user.username if authenticated else None,
+        context['id'],
+    )
+    cacheable = (not app.debug
+                 and (context['id'] is None or context['id'] in core.batteries)
+                 and '_flashes' not in flask.session)
+
+    html = index_cache.get(key) if cacheable else None
+    if html is None:
+        try:
+            html = flask.render_template('index.html', **context)
+        except jinja2.TemplateSyntaxError as e:
+            app.logger.error("Template syntax error on {}:{}".format(e.filename, e.lineno))
+            raise
+        if cacheable:
+            index_cache[key] = html
+
+    response = flask.make_response(html)
+    # The page differs per user, so only allow the browser to cache it,
+    # and make it revalidate using the ETag.
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.add_etag()
+    return response.make_conditional(flask.request)
+
+COMMANDS_PAGE_SIZE = 50
+COMMANDS_MAX_PAGE_SIZE = 500
+
+def parse_iso_timestamp(timestamp):
+    """ Parse a timestamp as produced by datetime.isoformat(). """
+    for fmt in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return datetime.strptime(timestamp, fmt)
+        except ValueError:
+            pass
+    flask.abort(400, 'Invalid timestamp: {}'.format(timestamp))
+
+def command_log(battery):
+    """
+    Return a page of the command log as JSON. The next page can be
+    requested by passing the before and before_id values from the
+    returned next field.
+    """
+    args = flask.request.args
+
+    acked = args.get('acked')
+    if acked is not None:
+        if acked not in ('0', '1'):
+            flask.abort(400, 'acked should be 0 or 1')
+        acked = acked == '1'
+
+    before = None
+    if 'before' in args:
+        before_id = args.get('before_id', type=int)
+        if before_id is None:
+            flask.abort(400, 'before requires before_id')
+        before = (parse_iso_timestamp(args['before']), before_id)
+
+    limit = args.get('limit', COMMANDS_PAGE_SIZE, type=int)
+    limit = min(COMMANDS_MAX_PAGE_SIZE, max(1, limit))
+
+    db = app.get_db()
+    # Fetch one extra row to find out if there is a next page
+    rows = database.get_commands(db, battery=battery, username=args.get('user'),
+                                 acked=acked, before=before, limit=limit + 1)
+    commands = []
+    for row in rows[:limit]:
+        config = database.config_row_to_message(row)
+        config['ackLatency'] = row['ackLatency']
+        commands.append(config)
+
+    next_page = None
+    if len(rows) > limit:
+        last = commands[-1]
+        next_page = {
+            'before': last['timestamp'].isoformat(),
+            'before_id': last['id'],
+        }
+
+    return flask.jsonify({
+        'commands': [websocket.convert_timestamp(c) for c in commands],
+        'next': next_page,
+    })
+
+@app.route('/api/battery/<battery>/commands')
+@flask_user.login_required
+def battery_commands(battery):
+    return command_log(battery)
+
+@app.route('/api/commands')
+@flask_user.login_required
+def commands():
+    return command_log(None)
+
+@app.route('/api/battery/<battery>/status')
+@flask_user.login_required
+def battery_status(battery):
+    """
+    Return the statuses of a battery between the start and end
+    timestamps (defaulting to the last day), including archived ones.
+    """
+    args = flask.request.args
+    end = parse_iso_timestamp(args['end']) if 'end' in args else datetime.now()
+    start = parse_iso_timestamp(args['start']) if 'start' in args else end - timedelta(days=1)
+
+    db = app.get_db()
+    rows = archive.get_status_rows(db, battery, start, end)
+    return flask.jsonify({
+        'statuses': [websocket.convert_timestamp(database.status_row_to_message(r)) for r in rows],
+    })
 
 # vim: set sts=4 sw=4 expandtab:
@@ -16,7 +16,7 @@ def convert_timestamp(info):
     string. Returns a copy of the dict passed.
     """
     info = dict(info)
-    for key in ('timestamp', 'ackTimestamp'):
+    for key in ('timestamp', 'ackTimestamp', 'lastTimestamp'):
         timestamp = info.get(key, None)
         if timestamp:
             info[key] = timestamp.isoformat()
@@ -26,6 +26,11 @@ def convert_timestamp(info):
 def handle_select_battery(msg):
     battery = msg['battery']
     app.logger.debug("Selected battery: %s", battery)
+    # Send the recent history in columnar form, when requested
+    if msg.get('history'):
+        history = core.history_for_battery(battery)
+        app.logger.debug("Sending history with %s entries", len(history['timestamps']))
+        emit('history', history)
     status = core.status_for_battery(battery)
     # Send the most recent status, if any
     if status:
@@ -56,6 +61,10 @@ def send_status(status, battery):
     status = convert_timestamp(status)
     app.socketio.emit('status', status, room=battery)
 
+def send_heartbeat(battery, timestamp):
+    app.logger.debug("Broadcasting heartbeat for %s", battery)
+    app.socketio.emit('heartbeat', {'battery': battery, 'timestamp': timestamp.isoformat()}, room=battery)
+
 def send_config(config):
     battery = config['battery']
     app.logger.debug("Broadcasting config for %s:\n%s", battery, core.pp_obj(config))
@@ -0,0 +1,45 @@
+import os
+import sys
+import types
+import shutil
+import sqlite3
+import importlib.util
+import pytest
+
+@pytest.fixture(scope='session')
+def app(tmp_path_factory):
+    """
+    Import the app with a test config, a fresh sqlite database and a
+    copy of the static files, without connecting to TTN.
+    """
+    tmp = tmp_path_factory.mktemp('webapp')
+
+    config = types.ModuleType('config')
+    config.SECRET_KEY = 'test'
+    config.TTN_SKIP = True
+    config.DATABASE = str(tmp / 'app.db')
+    config.SQLALCHEMY_DATABASE_URI = 'sqlite:///' + config.DATABASE
+    sys.modules['config'] = config
+
+    package_dir = importlib.util.find_spec('app').submodule_search_locations[0]
+    db = sqlite3.connect(config.DATABASE)
+    with open(os.path.join(package_dir, 'schema.sql')) as f:
+        db.executescript(f.read())
+    db.close()
+
+    # calibration.ini is read from and written to the working directory
+    cwd = os.getcwd()
+    os.chdir(str(tmp))
+    try:
+        import app as package
+    finally:
+        os.chdir(cwd)
+
+    app = package.app
+    app.config['TESTING'] = True
+    with app.app_context():
+        package.database.sqla.create_all()
+    # Build assets into a copy, to keep the source tree clean
+    shutil.copytree(app.static_folder, str(tmp / 'static'))
+    app.static_folder = str(tmp / 'static')
+    return app
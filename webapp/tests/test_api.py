@@ -0,0 +1,77 @@
+from datetime import datetime, timedelta
+import pytest
+
+BATTERY = 'lankheet-1'
+
+@pytest.fixture
+def client(app):
+    """ A test client logged in as a user. """
+    from app import auth
+    with app.app_context():
+        user = auth.User.query.filter_by(username='tester').first()
+        if user is None:
+            user = auth.User(username='tester', email='tester@example.org', active=True,
+                             confirmed_at=datetime.now())
+            auth.db.session.add(user)
+            auth.db.session.commit()
+        user_id = user.id
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = str(user_id)
+    return client
+
+def insert_command(app, timestamp, ack_after=None):
+    from app import database
+    config = {
+        'battery': BATTERY,
+        'username': 'tester',
+        'timestamp': timestamp,
+        'ackTimestamp': timestamp + ack_after if ack_after else None,
+        'manualTimeout': 0,
+        'pump': [0, 0, 0, 0],
+        'targetFlow': 10,
+        'targetLevel': [50, 50, 50],
+        'minLevel': [10, 10, 10],
+        'maxLevel': [90, 90, 90],
+    }
+    with app.app_context():
+        database.insert_from_dict(app.get_db(), 'config', database.config_message_to_row(config))
+
+def test_command_log_pages_through_equal_timestamps(app, client):
+    base = datetime(2020, 1, 1, 12, 0, 0, 500000)
+    # Three commands sharing a timestamp, so pages split in between them
+    timestamps = [base] * 3 + [base + timedelta(minutes=1)] * 2 + [base + timedelta(minutes=2)] * 2
+    for timestamp in timestamps:
+        insert_command(app, timestamp, ack_after=timedelta(seconds=3))
+
+    seen = []
+    url = '/api/battery/{}/commands'.format(BATTERY)
+    response = client.get(url, query_string={'limit': 2})
+    while True:
+        assert response.status_code == 200
+        page = response.get_json()
+        assert len(page['commands']) <= 2
+        seen.extend(page['commands'])
+        if page['next'] is None:
+            break
+        assert page['next']['before_id'] is not None
+        response = client.get(url, query_string=dict(page['next'], limit=2))
+
+    assert len(seen) == len(timestamps)
+    assert len({c['id'] for c in seen}) == len(timestamps)
+    keys = [(c['timestamp'], c['id']) for c in seen]
+    assert keys == sorted(keys, reverse=True)
+    assert all(c['ackLatency'] == 3 for c in seen)
+
+def test_command_log_filters_on_ack_state(app, client):
+    insert_command(app, datetime(2021, 1, 1), ack_after=None)
+    response = client.get('/api/commands?acked=0')
+    assert response.status_code == 200
+    commands = response.get_json()['commands']
+    assert commands
+    assert all(c['ackTimestamp'] is None and c['ackLatency'] is None for c in commands)
+
+def test_command_log_requires_login(app):
+    response = app.test_client().get('/api/commands')
+    assert response.status_code != 200
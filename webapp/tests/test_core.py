@@ -0,0 +1,34 @@
+import sqlite3
+
+DEVICE = 'stuurkast-3'
+BATTERY = 'lankheet-2'
+PAYLOAD = bytes([0, 0, 0, 0, 0, 0, 10, 10, 5, 100, 100, 100,
+                 90, 90, 90, 50, 50, 50, 200, 200, 200, 0, 0])
+
+def status_rows(app, battery):
+    db = sqlite3.connect(app.config['DATABASE'])
+    db.row_factory = sqlite3.Row
+    try:
+        return db.execute('select * from status where battery = ?', [battery]).fetchall()
+    finally:
+        db.close()
+
+def test_identical_uplinks_are_recorded_as_repeat(app):
+    from app import mqtt
+
+    msg = {'dev_id': DEVICE, 'port': 2}
+    assert mqtt.process_data(app, msg, PAYLOAD)
+    assert mqtt.process_data(app, msg, PAYLOAD)
+
+    rows = status_rows(app, BATTERY)
+    assert len(rows) == 1
+    assert rows[0]['id'] is not None
+    assert rows[0]['repeatCount'] == 1
+    assert rows[0]['lastTimestamp'] > rows[0]['timestamp']
+
+    # A changed payload is stored in full again
+    changed = bytes([0, 0, 0, 0, 0, 0, 11]) + PAYLOAD[7:]
+    assert mqtt.process_data(app, msg, changed)
+    rows = status_rows(app, BATTERY)
+    assert len(rows) == 2
+    assert rows[1]['repeatCount'] == 0
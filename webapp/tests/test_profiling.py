@@ -0,0 +1,46 @@
+import os
+import json
+import base64
+
+DEVICE = 'stuurkast-3'
+BATTERY = 'lankheet-1'
+
+def status_payload(app, flow):
+    """ Return a payload that matches the config seeded by profile-ingest. """
+    from app import mqtt, profiling
+
+    config = dict(profiling.DEFAULT_CONFIG)
+    mqtt.calibrate_config(app, BATTERY, config)
+    return bytes([0, 0, 0, 0, 0, 0, flow, flow, 0, 100, 100, 100]
+                 + config['targetLevelRaw'] + config['minLevelRaw'] + config['maxLevelRaw']
+                 + [0, 0])
+
+def test_profile_ingest_records_repeats(app, tmp_path, monkeypatch):
+    from app import database
+
+    payloads = [status_payload(app, 10)] * 3 + [status_payload(app, 11)]
+    capture = tmp_path / 'capture.jsonl'
+    with open(str(capture), 'w') as f:
+        for payload in payloads:
+            f.write(json.dumps({
+                'app_id': app.config['TTN_APP_ID'],
+                'dev_id': DEVICE,
+                'port': 1,
+                'payload_raw': base64.b64encode(payload).decode('ascii'),
+            }) + '\n')
+
+    # calibration.ini is written to the working directory
+    monkeypatch.chdir(str(tmp_path))
+    path = app.config['DATABASE']
+    try:
+        result = app.test_cli_runner().invoke(args=[
+            'profile-ingest', '--input', str(capture), '--no-config-from-db',
+            '--output', str(tmp_path / 'profile'),
+        ])
+    finally:
+        database.use_sqlite_db(path)
+
+    assert result.exit_code == 0, result.output
+    assert '2 stored as new status, 2 as repeat' in result.output
+    for ext in ('.txt', '.prof', '.folded'):
+        assert os.path.exists(str(tmp_path / ('profile' + ext)))
@@ -0,0 +1,94 @@
+import os
+import re
+import time
+from datetime import datetime
+
+BATTERY = 'lankheet-1'
+
+def test_cold_client_time_to_first_status(app, record_testsuite_property):
+    from app import core
+
+    result = app.test_cli_runner().invoke(args=['build-assets'])
+    assert result.exit_code == 0, result.output
+
+    core.batteries[BATTERY]['status'] = {
+        'battery': BATTERY,
+        'timestamp': datetime.now(),
+        'manualTimeout': 0,
+        'panic': False,
+        'pump': [0, 0, 0, 0],
+        'forwardFlow': [10, 10],
+        'reverseFlow': [0, 0],
+        'currentLevel': [50, 60, 70],
+    }
+
+    # A cold client: no cached page or assets, nor any ETags
+    start = time.perf_counter()
+    client = app.test_client()
+    response = client.get('/?id=' + BATTERY)
+    assert response.status_code == 200
+    index_etag = response.headers['ETag']
+
+    urls = re.findall(r'(?:src|href)="(/static/[^"]+)"', response.get_data(as_text=True))
+    assert urls
+    for url in urls:
+        assert url.startswith('/static/dist/')
+        response = client.get(url, headers={'Accept-Encoding': 'gzip, br'})
+        assert response.status_code == 200
+        assert response.headers['Content-Encoding'] in ('br', 'gzip')
+        assert 'Accept-Encoding' in response.headers['Vary']
+        assert 'immutable' in response.headers['Cache-Control']
+        assert response.headers['ETag']
+        response.close()
+
+    socket = app.socketio.test_client(app)
+    socket.emit('select_battery', {'battery': BATTERY})
+    received = [msg['name'] for msg in socket.get_received()]
+    elapsed = time.perf_counter() - start
+
+    assert 'status' in received
+    # Reported in the junitxml output (pytest --junitxml=...)
+    record_testsuite_property('time_to_first_status', round(elapsed, 3))
+
+    # A warm client revalidates the page and its assets
+    response = client.get('/?id=' + BATTERY, headers={'If-None-Match': index_etag})
+    assert response.status_code == 304
+    for url in urls:
+        response = client.get(url, headers={'Accept-Encoding': 'gzip, br'})
+        etag = response.headers['ETag']
+        response.close()
+        response = client.get(url, headers={'Accept-Encoding': 'gzip, br', 'If-None-Match': etag})
+        assert response.status_code == 304
+
+def test_uncompressed_without_accept_encoding(app):
+    client = app.test_client()
+    response = client.get('/static/index.css')
+    assert response.status_code == 200
+    assert 'Content-Encoding' not in response.headers
+    assert 'immutable' not in response.headers.get('Cache-Control', '')
+    response.close()
+
+def test_rebuild_keeps_previous_assets(app):
+    from app import assets
+
+    runner = app.test_cli_runner()
+    assert runner.invoke(args=['build-assets']).exit_code == 0
+    old = assets.manifest['index.css']
+
+    with open(os.path.join(app.static_folder, 'index.css'), 'a') as f:
+        f.write('\n/* changed */\n')
+    assert runner.invoke(args=['build-assets']).exit_code == 0
+    new = assets.manifest['index.css']
+    assert new != old
+
+    # Pages rendered before the rebuild can still load the old file
+    client = app.test_client()
+    for filename in (old, new):
+        response = client.get('/static/' + filename)
+        assert response.status_code == 200
+        response.close()
+
+    result = runner.invoke(args=['build-assets', '--prune'])
+    assert result.exit_code == 0
+    assert not os.path.exists(os.path.join(app.static_folder, old))
+    assert os.path.exists(os.path.join(app.static_folder, new))